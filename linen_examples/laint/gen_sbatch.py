@@ -33,10 +33,24 @@ parser.add_argument('--num-cpus', '-nc', type=int, default=16,
     help='The number of cpus to be used')
 parser.add_argument('--num-samples', '-sample', type=int, default=None,
     help='Randomly sample args multi-times instead of sweeping when not None')
+parser.add_argument('--chunk-size', '-cs', type=int, default=1,
+    help='The number of runs executed one after another in each array task')
+parser.add_argument('--scratch-dir', '-sd', type=str, default=None,
+    help='Node-local dir to write logs to, copied to logs-dir at the end')
 
 args = parser.parse_args()
+if args.chunk_size < 1:
+    parser.error('--chunk-size must be at least 1')
+if args.scratch_dir is not None and not args.logs_dir:
+    # The log would stay on node-local scratch and be lost with it.
+    parser.error('--scratch-dir needs a --logs-dir to copy the log back to')
 
-def write_cmds(f, cmds):
+def write_manifest(f, cmds):
+    for cmd in cmds:
+        f.write('{}\n'.format(cmd))
+
+def write_cmds(f, cmds, manifest):
+    num_tasks = -(-len(cmds) // args.chunk_size)
     f.write('#!/bin/bash\n')
     f.write('#SBATCH --partition={}\n'.format(args.gpu_type))
     f.write('#SBATCH --qos={}\n'.format(args.qos_type))
@@ -44,19 +58,46 @@ def write_cmds(f, cmds):
     f.write('#SBATCH --gres=gpu:{}\n'.format(args.num_gpus))
     f.write('#SBATCH --cpus-per-task={}\n'.format(args.num_cpus))
     f.write('#SBATCH --array=0-{}%{}\n'.format(
-        len(cmds) - 1, args.parallel_runs))
+        num_tasks - 1, args.parallel_runs))
     log_file = '{}-%A_%a.log'.format('sweep')
-    if args.logs_dir is not None:
-        log_file = osp.join(args.logs_dir, log_file)
-    f.write('#SBATCH --output={}\n'.format(log_file))
+    if args.scratch_dir is not None:
+        # Keep the log on local disk while the task runs to spare the network
+        # FS many small appends, it is copied back once at the end.
+        f.write('#SBATCH --output={}\n'.format(
+            osp.join(args.scratch_dir, log_file)))
+    elif args.logs_dir is not None:
+        f.write('#SBATCH --output={}\n'.format(
+            osp.join(args.logs_dir, log_file)))
+    else:
+        f.write('#SBATCH --output={}\n'.format(log_file))
     f.write('export XLA_FLAGS=--xla_gpu_cuda_data_dir=/pkgs/cuda-10.1\n')
-    f.write('list=(\n')
-    for i, cmd in enumerate(cmds):
-        f.write('  "{}"\n'.format(cmd))
-    f.write(')\n')
-    f.write('${list[SLURM_ARRAY_TASK_ID]}')
+    # Commands live one per line in the manifest, each task reads only its
+    # own line(s) instead of parsing the whole sweep as a bash array.
+    f.write('SWEEP_CMDS="{}"\n'.format(manifest))
     # NOTE: comment this one to use self-managed dir for checkpoints
-    f.write(' --ckptdir /checkpoint/${SLURM_JOB_USER}/${SLURM_JOB_ID}\n')
+    if args.chunk_size == 1:
+        f.write('cmd=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" '
+                '"${SWEEP_CMDS}")\n')
+        f.write('eval "${cmd}')
+        f.write(' --ckptdir /checkpoint/${SLURM_JOB_USER}/${SLURM_JOB_ID}"\n')
+    else:
+        # Each task runs its chunk of the manifest in sequence, with one
+        # checkpoint dir per run.
+        f.write('start=$((SLURM_ARRAY_TASK_ID * {}))\n'.format(
+            args.chunk_size))
+        f.write('for ((i = start; i < start + {} && i < {}; i++)); '
+                'do\n'.format(args.chunk_size, len(cmds)))
+        f.write('  cmd=$(sed -n "$((i + 1))p" "${SWEEP_CMDS}")\n')
+        f.write('  eval "${cmd}')
+        f.write(' --ckptdir /checkpoint/${SLURM_JOB_USER}/${SLURM_JOB_ID}/${i}"'
+                '\n')
+        f.write('done\n')
+    if args.scratch_dir is not None:
+        f.write('mkdir -p {}\n'.format(args.logs_dir))
+        f.write('cp {} {}\n'.format(
+            osp.join(args.scratch_dir,
+                     'sweep-${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}.log'),
+            args.logs_dir))
 
 def main():
     cmds = []
@@ -75,8 +116,11 @@ def main():
                                 "--config.bucket_length={} "
                                 "--config.latent={} "
                                 "".format(workdir, data_dir, vocab_path, bs, lr, bl, latent))
+    manifest = osp.abspath(args.output + '.cmds')
+    with open(manifest, 'w') as f:
+        write_manifest(f, cmds)
     with open(args.output, 'w') as f:
-        write_cmds(f, cmds)
+        write_cmds(f, cmds, manifest)
 
 if __name__ == "__main__":
     main()
@@ -1,101 +1,277 @@
 import numpy as np
 import collections
-import random
+import concurrent.futures
+import glob
+import hashlib
+import heapq
+import itertools
+import operator
+import os
+import shutil
+import sys
+import tempfile
 filename = "episodes.npz"
+shard_pattern = "episodes_shard_*.npz"
+cache_root = "cache"
+output_names = ("vocab.npy", "train.npz", "valid.npz", "test.npz")
+# A cache entry also keeps the vocab listing, which is replayed to stdout.
+cache_names = output_names + ("vocab.log",)
 
 all_examples = []
-tokens = []
 eos = '<eos>'
 pad = '<pad>'
 start = '<s>'
+unk = '<unk>'
+# Reserved ids, the remaining tokens are numbered by frequency after them.
+PAD_ID = 0
+START_ID = 1
+EOS_ID = 2
+# Only present when the vocab is capped by max_vocab_size.
+UNK_ID = 3
 
-def add_eos(sent):
-    return " ".join(sent.split() + [eos])
-
-def add_start(sent):
-    return " ".join([start] + sent.split())
-
-def encode(sent, vocab):
-    sent = sent.split()
-    encoded_sent = [vocab[s] for s in sent]
-    return encoded_sent
-
-def encode_dataset(dataset):
-    encoded = []
-    for s in dataset:
-        st, at, st_1, r, v = s
-        st = encode(st, vocab)
-        at = encode(at, vocab)
-        st_1 = encode(st_1, vocab)
-        s = (st, at, st_1, r, v)
-        encoded.append(s)
+def flatten_sentences(dataset):
+    # Slot-major order: all st, then all at, then all st_1, so that each slot
+    # encodes to one contiguous run of ids.
+    return [s[k] for k in range(3) for s in dataset]
+
+def encode_batch(sentences, vocab):
+    # Split every sentence once and map the flat token stream to ids in a
+    # single np.fromiter pass, returning the ids with per-sentence offsets.
+    # A capped vocab maps tokens it dropped to <unk>.
+    split_sents = [sent.split() for sent in sentences]
+    lengths = np.fromiter(map(len, split_sents), dtype=np.int64,
+                          count=len(split_sents))
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    tokens = itertools.chain.from_iterable(split_sents)
+    if unk in vocab:
+        unk_id = vocab[unk]
+        tokens = (vocab.get(t, unk_id) for t in tokens)
+    else:
+        tokens = map(vocab.__getitem__, tokens)
+    ids = np.fromiter(tokens, dtype=np.int32, count=offsets[-1])
+    return ids, offsets
+
+def id_dtype(vocab):
+    # Store ids as uint16 whenever the vocab fits, halving the size of the
+    # splits compared to int32.
+    if len(vocab) <= np.iinfo(np.uint16).max + 1:
+        return np.uint16
+    return np.int32
+
+def add_markers(ids, lengths, prefix, suffix, dtype=np.int32):
+    # Wrap every row of a flat id array in the given prefix and suffix ids,
+    # returning the new flat array and its row offsets.
+    new_lengths = lengths + len(prefix) + len(suffix)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    new_offsets = np.concatenate([[0], np.cumsum(new_lengths)])
+    out = np.empty(new_offsets[-1], dtype=dtype)
+    shift = np.repeat(new_offsets[:-1] - offsets[:-1] + len(prefix), lengths)
+    out[np.arange(len(ids)) + shift] = ids
+    for i, t in enumerate(prefix):
+        out[new_offsets[:-1] + i] = t
+    for i, t in enumerate(suffix):
+        out[new_offsets[1:] - len(suffix) + i] = t
+    return out, new_offsets.astype(np.int64)
+
+def pack_dataset(dataset, ids, offsets, dtype=np.int32):
+    # Struct-of-arrays layout: for each of st, at and st_1 a flat id array
+    # plus int64 row offsets, and float32 arrays for r and v.
+    # st and at are wrapped as <s> ... <eos>, st_1 only gets <eos>.
+    n = len(dataset)
+    lengths = np.diff(offsets)
+    markers = ([START_ID], [START_ID], [])
+    encoded = {}
+    for k, name in enumerate(("st", "at", "st1")):
+        # Slot k is a contiguous slice, so packing it needs no gather.
+        slot_ids = ids[offsets[k*n]:offsets[(k+1)*n]]
+        encoded[name + "_ids"], encoded[name + "_off"] = add_markers(
+            slot_ids, lengths[k*n:(k+1)*n], markers[k], [EOS_ID], dtype)
+    encoded["r"] = np.fromiter((s[3] for s in dataset), dtype=np.float32,
+                               count=len(dataset))
+    encoded["v"] = np.fromiter((s[4] for s in dataset), dtype=np.float32,
+                               count=len(dataset))
     return encoded
 
+def encode_dataset(dataset, vocab):
+    ids, offsets = encode_batch(flatten_sentences(dataset), vocab)
+    return pack_dataset(dataset, ids, offsets, id_dtype(vocab))
+
+_worker_vocab = None
+
+def _init_worker(vocab):
+    # Each worker receives the vocab once instead of once per shard.
+    global _worker_vocab
+    _worker_vocab = vocab
+
+def _encode_shard(sentences):
+    return encode_batch(sentences, _worker_vocab)
+
+def _merge_shards(results):
+    if not results:
+        return np.empty(0, dtype=np.int32), np.zeros(1, dtype=np.int64)
+    ids = np.concatenate([ids for ids, _ in results])
+    lengths = np.concatenate([np.diff(offsets) for _, offsets in results])
+    return ids, np.concatenate([[0], np.cumsum(lengths)])
+
+def encode_splits(datasets, vocab, num_workers=None):
+    # Encode all splits on one process pool. Every split is cut into one shard
+    # per worker and all shards are submitted up front, so the small splits
+    # run alongside the train split instead of after it.
+    num_workers = num_workers or os.cpu_count() or 1
+    if num_workers <= 1:
+        return [encode_dataset(dataset, vocab) for dataset in datasets]
+    with concurrent.futures.ProcessPoolExecutor(
+            num_workers, initializer=_init_worker,
+            initargs=(vocab,)) as executor:
+        futures = []
+        for dataset in datasets:
+            sentences = flatten_sentences(dataset)
+            shard_size = max(-(-len(sentences) // num_workers), 1)
+            futures.append([
+                executor.submit(_encode_shard, sentences[i:i+shard_size])
+                for i in range(0, len(sentences), shard_size)])
+        return [pack_dataset(dataset, *_merge_shards(
+                    [f.result() for f in split_futures]), id_dtype(vocab))
+                for dataset, split_futures in zip(datasets, futures)]
+
+def load_episode_file(path):
+    with open(path, 'rb') as f:
+        return np.load(f, allow_pickle=True)["a"]
+
+def episode_paths():
+    return sorted(glob.glob(shard_pattern)) or [filename]
+
+def load_episodes():
+    # Read the producer's episode shards if present, else the single archive.
+    # Shards are decoded concurrently, and episodes are addressed through a
+    # global (shard_id, row_id) index so that only the index gets shuffled.
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        shards = list(executor.map(load_episode_file, episode_paths()))
+    lens = [len(shard) for shard in shards]
+    index = np.stack([np.repeat(np.arange(len(shards)), lens),
+                      np.concatenate([np.arange(n) for n in lens])],
+                     axis=1).astype(np.int64)
+    return shards, index
+
+def cache_key(paths, *params):
+    # Digest of the episode files, this script and the split parameters, so
+    # that a change to any of them invalidates the cached splits.
+    h = hashlib.blake2b(digest_size=8)
+    for path in list(paths) + [__file__]:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    h.update(repr(params).encode())
+    return h.hexdigest()
+
+def gather_episodes(shards, index):
+    return [shards[shard_id][row_id] for shard_id, row_id in index]
 
 def preprocess_dataset(episodes):
-    tokens = []
+    counts = collections.Counter()
     new_episodes = []
     for episode_index in range(len(episodes)):
         episode = episodes[episode_index]
         for s in episode:
             st, at, st_1, r, v = s
-            st = add_start(add_eos(st))
-            at = add_start(add_eos(at))
-            st_1 = add_eos(st_1)
             s = (st, at, st_1, r, v)
             for sent in s[:3]:
-                tokens += sent.split()
+                counts.update(sent.split())
             new_episodes.append(s)
-    return new_episodes, tokens
+    # The markers are added at encoding time, count them as they will appear:
+    # <eos> ends every sentence and <s> starts st and at.
+    counts[eos] += 3 * len(new_episodes)
+    counts[start] += 2 * len(new_episodes)
+    return new_episodes, counts
 
 
-if __name__ == "__main__":
-    train_frac = 0.95
+def build_vocab(counts, max_vocab_size=None):
+    # Reserved tokens first, then tokens by decreasing frequency. heapq picks
+    # the top tokens without sorting the full counter, and ties keep their
+    # first-seen order as with a stable sort.
+    vocab = collections.OrderedDict()
+    vocab.update({pad: PAD_ID, start: START_ID, eos: EOS_ID})
+    if max_vocab_size is None:
+        num_tokens = len(counts)
+    else:
+        vocab.update({unk: UNK_ID})
+        num_tokens = max(max_vocab_size - len(vocab), 0)
+    top = heapq.nlargest(num_tokens,
+                         ((v, c) for v, c in counts.items() if v not in vocab),
+                         key=operator.itemgetter(1))
+    first_id = len(vocab)
+    vocab.update({v: idx+first_id for idx, (v, _) in enumerate(top)})
+    return vocab
+
+
+def build_splits(train_frac, seed, max_vocab_size, out_dir):
     valid_frac = (1-train_frac)/2
     test_frac = (1-train_frac)/2
 
+    shards, index = load_episodes()
 
-    with open(filename, 'rb') as f:
-        batch_episodes = np.load(f, allow_pickle=True)["a"]
-
-    total_episodes = len(batch_episodes)
+    total_episodes = len(index)
     num_train = round(total_episodes * train_frac)
     num_valid = round(total_episodes * valid_frac)
-    random.shuffle(batch_episodes)
-    train_episodes = batch_episodes[:num_train]
-    valid_episodes = batch_episodes[num_train:num_train+num_valid]
-    test_episodes = batch_episodes[num_train+num_valid:]
-
-    train_dataset, train_tokens = preprocess_dataset(train_episodes)
-    valid_dataset, valid_tokens = preprocess_dataset(valid_episodes)
-    test_dataset, test_tokens = preprocess_dataset(test_episodes)
-
-    tokens = train_tokens + valid_tokens + test_tokens
-    counts = collections.Counter(tokens)
-    vocab_size = len(counts)
-    sorted_counts = collections.OrderedDict(
-        sorted(counts.items(), key=lambda x: x[1], reverse=True))
-    vocab = collections.OrderedDict()
-    vocab.update({pad: 0})
-    vocab.update({v:idx+1 for v, idx in zip(sorted_counts.keys(), range(vocab_size))})
-    for v,idx in vocab.items():
-        print(idx, v, counts[v])
-
-    train_dataset = encode_dataset(train_dataset)
-    valid_dataset = encode_dataset(valid_dataset)
-    test_dataset = encode_dataset(test_dataset)
-    random.shuffle(train_dataset)
-
-    np.save("vocab.npy", vocab)
-    np.save("train.npy", train_dataset)
-    np.save("valid.npy", valid_dataset)
-    np.save("test.npy", test_dataset)
-
-
+    rng = np.random.default_rng(seed)
+    perm = rng.permutation(total_episodes)
+    train_episodes = gather_episodes(shards, index[perm[:num_train]])
+    valid_episodes = gather_episodes(
+        shards, index[perm[num_train:num_train+num_valid]])
+    test_episodes = gather_episodes(shards, index[perm[num_train+num_valid:]])
 
+    # Preprocessing stays serial: the train split is most of the work, and
+    # shipping the episodes and rows through a process pool costs more than it
+    # saves.
+    train_dataset, train_counts = preprocess_dataset(train_episodes)
+    valid_dataset, valid_counts = preprocess_dataset(valid_episodes)
+    test_dataset, test_counts = preprocess_dataset(test_episodes)
 
+    counts = train_counts + valid_counts + test_counts
+    vocab = build_vocab(counts, max_vocab_size)
+    # One write for the whole listing rather than a print per token.
+    listing = "".join(
+        "{} {} {}\n".format(idx, v, counts[v]) for v, idx in vocab.items())
+    sys.stdout.write(listing)
 
+    train_dataset = [train_dataset[i]
+                     for i in rng.permutation(len(train_dataset))]
+    train_dataset, valid_dataset, test_dataset = encode_splits(
+        (train_dataset, valid_dataset, test_dataset), vocab)
 
+    # Write to a scratch dir of its own first, so that an interrupted run
+    # leaves no partial cache entry behind and concurrent runs do not share it.
+    cache_dir = os.path.dirname(out_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir)
+    with open(os.path.join(tmp_dir, "vocab.log"), "w") as f:
+        f.write(listing)
+    np.save(os.path.join(tmp_dir, "vocab.npy"), vocab)
+    np.savez_compressed(os.path.join(tmp_dir, "train.npz"), **train_dataset)
+    np.savez_compressed(os.path.join(tmp_dir, "valid.npz"), **valid_dataset)
+    np.savez_compressed(os.path.join(tmp_dir, "test.npz"), **test_dataset)
+    # Drop any incomplete entry left at out_dir, os.replace cannot overwrite a
+    # non-empty directory.
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
 
 
+if __name__ == "__main__":
+    train_frac = 0.95
+    seed = 0
+    # Keep every token when None, else map the rarest ones to <unk>.
+    max_vocab_size = None
 
+    # Re-running on unchanged episodes reuses the splits from the cache.
+    cache_dir = os.path.join(
+        cache_root,
+        cache_key(episode_paths(), train_frac, seed, max_vocab_size))
+    if all(os.path.exists(os.path.join(cache_dir, name))
+           for name in cache_names):
+        print("Reusing cached splits from", cache_dir, file=sys.stderr)
+        with open(os.path.join(cache_dir, "vocab.log")) as f:
+            sys.stdout.write(f.read())
+    else:
+        build_splits(train_frac, seed, max_vocab_size, cache_dir)
+    for name in output_names:
+        shutil.copyfile(os.path.join(cache_dir, name), name)
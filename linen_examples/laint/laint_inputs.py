@@ -69,7 +69,6 @@ lines from `my_file.txt` as follows::
 """
 
 import math
-import random
 
 from absl import logging
 import numpy as np
@@ -738,6 +737,28 @@ def _pad_to_multiple_of(x, y, axis):
                 constant_values=x.dtype.type(0))
 
 
+def load_int_dataset(path):
+  """Loads a split written by int_data/k3l7_10k/read_episodes.py.
+
+  Each of st, at and st_1 is stored as a flat id array `<name>_ids` with row
+  offsets `<name>_off`; r and v are stored as float32 arrays.
+
+  Args:
+    path: path to the .npz file of the split.
+
+  Returns:
+    A dict from array name to the fully loaded numpy array.
+  """
+  with open(path, 'rb') as f:
+    data = np.load(f)
+    return {name: data[name] for name in data.files}
+
+
+def _ragged_row(ids, offsets, i):
+  """Returns row i of a flat ids array with row offsets as int32."""
+  return ids[offsets[i]:offsets[i + 1]].astype(np.int32)
+
+
 def int_latent_inputs(variable_shapes=True,
             batch_size_per_device=32, batch_size=None, eval_batch_size=32,
             bucket_length=32, buckets=None,
@@ -746,8 +767,8 @@ def int_latent_inputs(variable_shapes=True,
             id_to_mask=None, strict_pad_on_len=False):
   """
   """
-  train_dataset = np.load("int_data/k3l7_10k/train.npy", allow_pickle=True).tolist()
-  valid_dataset = np.load("int_data/k3l7_10k/valid.npy", allow_pickle=True).tolist()
+  train_dataset = load_int_dataset("int_data/k3l7_10k/train.npz")
+  valid_dataset = load_int_dataset("int_data/k3l7_10k/valid.npz")
 
   # 1. a. st  : current goal.                 (sequence)
   #    b. at  : current action.               (sequence)
@@ -759,16 +780,17 @@ def int_latent_inputs(variable_shapes=True,
 
   def dataset_to_stream(dataset):
     # for example in dataset:
+    num_examples = len(dataset["r"])
     i = 0
     while True:
-      if i%len(dataset) == 0:
-        random.shuffle(dataset)
-      st, at, st_1, r, v = dataset[i%(len(dataset))]
-      st = np.array(st).astype(np.int32)
-      at = np.array(at).astype(np.int32)
-      st_1 = np.array(st_1).astype(np.int32)
-      r = np.array(r).astype(np.float32)
-      v = np.array(v).astype(np.float32)
+      if i%num_examples == 0:
+        order = np.random.permutation(num_examples)
+      j = order[i%num_examples]
+      st, at, st_1 = [
+          _ragged_row(dataset[name + "_ids"], dataset[name + "_off"], j)
+          for name in ("st", "at", "st1")]
+      r = dataset["r"][j]
+      v = dataset["v"][j]
       i += 1
       yield st, at, st_1, r, v
 
@@ -48,6 +48,7 @@ class TransformerConfig:
   attention_dropout_rate: float = 0.1
   deterministic: bool = False
   decode: bool = False
+  quantized: bool = False
   latent: bool = False
   num_latent_tokens: int = 0
   kernel_init: Callable = nn.initializers.xavier_uniform()
@@ -94,6 +95,94 @@ def sinusoidal_init(max_len=2048,
   return init
 
 
+class Embed(nn.Module):
+  """Embedding Module that can also read an int8 quantized table.
+
+  Has the same params and results as nn.Embed. With quantized=True the
+  embedding table holds int8 values and a "scale" param one float32 scale per
+  row, as written by quantize_params in train.py. Rows are gathered before
+  they are scaled, so the table is never dequantized as a whole.
+
+  Attributes:
+    num_embeddings: number of embeddings.
+    features: number of feature dimensions for each embedding.
+    embedding_init: embedding initializer.
+    quantized: whether the table is int8 quantized.
+  """
+  num_embeddings: int
+  features: int
+  embedding_init: Callable = nn.initializers.normal(stddev=1.0)
+  quantized: bool = False
+
+  def setup(self):
+    shape = (self.num_embeddings, self.features)
+    if self.quantized:
+      self.embedding = self.param('embedding', nn.initializers.zeros, shape,
+                                  jnp.int8)
+      self.scale = self.param('scale', nn.initializers.ones,
+                              (self.num_embeddings, 1))
+    else:
+      self.embedding = self.param('embedding', self.embedding_init, shape)
+
+  def __call__(self, inputs):
+    """Embeds the inputs along the last dimension.
+
+    Args:
+      inputs: integer input data, all dimensions are batch dimensions.
+
+    Returns:
+      Embedded input data with an additional `features` dimension.
+    """
+    if not jnp.issubdtype(inputs.dtype, jnp.integer):
+      raise ValueError('Input type must be an integer or unsigned integer.')
+    x = self.embedding[inputs]
+    if self.quantized:
+      x = x.astype(jnp.float32) * self.scale[inputs]
+    return x
+
+  def attend(self, query):
+    """Inner products of the query vectors with every embedding.
+
+    Args:
+      query: array with last dimension `features`.
+
+    Returns:
+      Array with final dimension `num_embeddings`.
+    """
+    if self.quantized:
+      # Scale the [..., num_embeddings] output rather than the table.
+      return (jnp.dot(query, self.embedding.T.astype(query.dtype)) *
+              self.scale[:, 0].astype(query.dtype))
+    return jnp.dot(query, self.embedding.T)
+
+
+class QuantizedDense(nn.Module):
+  """Dense layer over an int8 kernel with one float32 scale per output.
+
+  Reads the "kernel", "scale" and "bias" params written by quantize_params in
+  train.py. The kernel is cast for the matmul and the scales are applied to
+  its [..., features] output.
+
+  Attributes:
+    features: the number of output features.
+    dtype: the dtype of the computation (default: float32).
+  """
+  features: int
+  dtype: Any = jnp.float32
+
+  @nn.compact
+  def __call__(self, inputs):
+    """Applies the quantized dense layer along the last dimension of inputs."""
+    inputs = jnp.asarray(inputs, self.dtype)
+    kernel = self.param('kernel', nn.initializers.zeros,
+                        (inputs.shape[-1], self.features), jnp.int8)
+    scale = self.param('scale', nn.initializers.ones, (1, self.features))
+    bias = self.param('bias', nn.initializers.zeros, (self.features,))
+    y = jnp.dot(inputs, kernel.astype(self.dtype))
+    y = y * jnp.asarray(scale, self.dtype)
+    return y + jnp.asarray(bias, self.dtype)
+
+
 class AddPositionEmbs(nn.Module):
   """Adds (optionally learned) positional embeddings to the inputs.
 
@@ -386,10 +475,11 @@ class Encoder(nn.Module):
     assert inputs.ndim == 2  # (batch, len)
     # Input Embedding
     if self.shared_embedding is None:
-      input_embed = nn.Embed(
+      input_embed = Embed(
           num_embeddings=cfg.vocab_size,
           features=cfg.emb_dim,
-          embedding_init=nn.initializers.normal(stddev=1.0))
+          embedding_init=nn.initializers.normal(stddev=1.0),
+          quantized=cfg.quantized)
     else:
       input_embed = self.shared_embedding
     x = inputs.astype('int32')
@@ -447,10 +537,11 @@ class Decoder(nn.Module):
 
     # Target Embedding
     if self.shared_embedding is None:
-      output_embed = nn.Embed(
+      output_embed = Embed(
           num_embeddings=cfg.output_vocab_size,
           features=cfg.emb_dim,
-          embedding_init=nn.initializers.normal(stddev=1.0))
+          embedding_init=nn.initializers.normal(stddev=1.0),
+          quantized=cfg.quantized)
     else:
       output_embed = self.shared_embedding
 
@@ -483,6 +574,9 @@ class Decoder(nn.Module):
       logits = output_embed.attend(y.astype(jnp.float32))
       # Correctly normalize pre-softmax logits for this shared case.
       logits = logits / jnp.sqrt(y.shape[-1])
+    elif cfg.quantized:
+      logits = QuantizedDense(
+          cfg.output_vocab_size, dtype=cfg.dtype, name='logitdense')(y)
     else:
       logits = nn.Dense(
           cfg.output_vocab_size,
@@ -508,10 +602,11 @@ class Transformer(nn.Module):
       if cfg.output_vocab_size is not None:
         assert cfg.output_vocab_size == cfg.vocab_size, (
             "can't share embedding with different vocab sizes.")
-      self.shared_embedding = nn.Embed(
+      self.shared_embedding = Embed(
           num_embeddings=cfg.vocab_size,
           features=cfg.emb_dim,
-          embedding_init=nn.initializers.normal(stddev=1.0))
+          embedding_init=nn.initializers.normal(stddev=1.0),
+          quantized=cfg.quantized)
     else:
       self.shared_embedding = None
 
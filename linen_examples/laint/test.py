@@ -6,14 +6,24 @@ batch_size = 32
 seed = 42
 
 parent_dir = "copy_data"
-raw_train_src = tf.data.TextLineDataset(osp.join(parent_dir, "train.src"))
-raw_train_tgt = tf.data.TextLineDataset(osp.join(parent_dir, "train.tgt"))
-raw_train = tf.data.Dataset.zip((raw_train_src, raw_train_tgt))
 
-#raw_valid = tf.data.TextLineDataset(osp.join(parent_dir, "valid"))
-#raw_test = tf.data.TextLineDataset(osp.join(parent_dir, "test"))
 
-for text_batch, label_batch in raw_train.take(100):
-    print("Question: ", text_batch.numpy())
-    print("Label:", label_batch.numpy())
-import pdb;pdb.set_trace()
+def main():
+    raw_train_src = tf.data.TextLineDataset(osp.join(parent_dir, "train.src"))
+    raw_train_tgt = tf.data.TextLineDataset(osp.join(parent_dir, "train.tgt"))
+    raw_train = tf.data.Dataset.zip((raw_train_src, raw_train_tgt))
+
+    #raw_valid = tf.data.TextLineDataset(osp.join(parent_dir, "valid"))
+    #raw_test = tf.data.TextLineDataset(osp.join(parent_dir, "test"))
+
+    # Pull a single batch instead of converting and printing row by row.
+    train_batches = raw_train.batch(batch_size).prefetch(
+        tf.data.experimental.AUTOTUNE)
+    text_batch, label_batch = next(iter(train_batches))
+    print("Question: ", text_batch[0].numpy())
+    print("Label:", label_batch[0].numpy())
+    print("Batch shapes:", text_batch.shape, label_batch.shape)
+
+
+if __name__ == "__main__":
+    main()
@@ -29,12 +29,19 @@ from jax import random
 import jax
 import jax.numpy as jnp
 import ml_collections
+from jax.scipy.special import logsumexp
 import numpy as np
 import tensorflow as tf
+try:
+  from jax.experimental import multihost_utils
+except ImportError:  # older jax
+  multihost_utils = None
 
 from flax import jax_utils
 from flax import linen as nn
 from flax import optim
+from flax import traverse_util
+from flax.core import freeze, unfreeze
 from flax.metrics import tensorboard
 from flax.training import checkpoints
 from flax.training import common_utils
@@ -43,7 +50,6 @@ import bleu
 import decode
 import input_pipeline
 import models
-import copy
 
 def create_learning_rate_scheduler(
     factors="constant * linear_warmup * rsqrt_decay",
@@ -72,34 +78,41 @@ def create_learning_rate_scheduler(
 
   Returns:
     a function learning_rate(step): float -> {"learning_rate": float}, the
-    step-dependent lr.
+    step-dependent lr. It is evaluated with NumPy on the host, so that the
+    schedule is not traced into the train step.
   """
   factors = [n.strip() for n in factors.split("*")]
 
+  # Resolve every factor to a small function once, so that step_fn is a
+  # straight sequence of calls.
+  def build_op(name):
+    if name == "constant":
+      return lambda step, ret: ret * base_learning_rate
+    elif name == "linear_warmup":
+      return lambda step, ret: ret * np.minimum(1.0, step / warmup_steps)
+    elif name in ("rsqrt_decay", "rsqrt_normalized_decay"):
+      return lambda step, ret: (ret * np.sqrt(warmup_steps) /
+                                np.sqrt(np.maximum(step, warmup_steps)))
+    elif name == "decay_every":
+      return lambda step, ret: ret * (decay_factor**(step // steps_per_decay))
+    elif name == "cosine_decay":
+      def cosine_decay(step, ret):
+        progress = np.maximum(0.0,
+                              (step - warmup_steps) / float(steps_per_cycle))
+        return ret * np.maximum(0.0,
+                                0.5 * (1.0 + np.cos(np.pi * (progress % 1.0))))
+      return cosine_decay
+    else:
+      raise ValueError("Unknown factor %s." % name)
+
+  ops = [build_op(name) for name in factors]
+
   def step_fn(step):
     """Step to learning rate function."""
     ret = 1.0
-    for name in factors:
-      if name == "constant":
-        ret *= base_learning_rate
-      elif name == "linear_warmup":
-        ret *= jnp.minimum(1.0, step / warmup_steps)
-      elif name == "rsqrt_decay":
-        ret *= jnp.sqrt(warmup_steps)
-        ret /= jnp.sqrt(jnp.maximum(step, warmup_steps))
-      elif name == "rsqrt_normalized_decay":
-        ret *= jnp.sqrt(warmup_steps)
-        ret /= jnp.sqrt(jnp.maximum(step, warmup_steps))
-      elif name == "decay_every":
-        ret *= (decay_factor**(step // steps_per_decay))
-      elif name == "cosine_decay":
-        progress = jnp.maximum(0.0,
-                               (step - warmup_steps) / float(steps_per_cycle))
-        ret *= jnp.maximum(0.0,
-                           0.5 * (1.0 + jnp.cos(jnp.pi * (progress % 1.0))))
-      else:
-        raise ValueError("Unknown factor %s." % name)
-    return jnp.asarray(ret, dtype=jnp.float32)
+    for op in ops:
+      ret = op(step, ret)
+    return np.asarray(ret, dtype=np.float32)
 
   return step_fn
 
@@ -123,16 +136,23 @@ def compute_weighted_cross_entropy(logits,
   if logits.ndim != targets.ndim + 1:
     raise ValueError("Incorrect shapes. Got shape %s logits and %s targets" %
                      (str(logits.shape), str(targets.shape)))
+  # Reduce in float32 even when the model computes in bfloat16.
+  logits = logits.astype(jnp.float32)
   vocab_size = logits.shape[-1]
   confidence = 1.0 - label_smoothing
   low_confidence = (1.0 - confidence) / (vocab_size - 1)
   normalizing_constant = -(
       confidence * jnp.log(confidence) + (vocab_size - 1) *
       low_confidence * jnp.log(low_confidence + 1e-20))
-  soft_targets = common_utils.onehot(
-      targets, vocab_size, on_value=confidence, off_value=low_confidence)
 
-  loss = -jnp.sum(soft_targets * nn.log_softmax(logits), axis=-1)
+  # Same as summing onehot soft targets times log_softmax(logits), without
+  # materializing either [batch, length, vocab] array.
+  lse = logsumexp(logits, axis=-1)
+  log_prob_true = jnp.take_along_axis(
+      logits, targets[..., None], axis=-1).squeeze(-1) - lse
+  sum_log_probs = logits.sum(axis=-1) - vocab_size * lse
+  loss = -(confidence * log_prob_true +
+           low_confidence * (sum_log_probs - log_prob_true))
   loss = loss - normalizing_constant
 
   normalizing_factor = np.prod(targets.shape)
@@ -186,8 +206,9 @@ def compute_metrics(logits, labels, weights, label_smoothing=0.0):
 def train_step(optimizer,
                batch,
                dropout_rng,
-               config,
-               learning_rate_fn,
+               lr,
+               dynamic_scale,
+               model,
                label_smoothing=0.0):
   """Perform a single training step."""
   # X_position and X_segmentation are needed only when using "packed examples"
@@ -203,16 +224,17 @@ def train_step(optimizer,
    inputs_positions, targets_positions,
    inputs_segmentation, targets_segmentation) = [
        batch.get(k, None) for k in train_keys]
-  teacher_forcing_targets = copy.deepcopy(targets)[:, :-1]
+  teacher_forcing_targets = targets[:, :-1]
   targets = targets[:, 1:]
-  weights = jnp.where(targets > 0, 1, 0).astype(jnp.float32)
 
-  # We handle PRNG splitting inside the top pmap to improve efficiency.
-  dropout_rng, new_dropout_rng = random.split(dropout_rng)
+  # Derive this step's dropout key from the step counter inside the top pmap
+  # instead of splitting it and carrying a new key back out every step.
+  step = optimizer.state.step
+  dropout_rng = random.fold_in(dropout_rng, step)
 
   def loss_fn(params):
     """loss function used for training."""
-    logits = models.Transformer(config).apply(
+    logits = model.apply(
         {"params": params},
         inputs,
         teacher_forcing_targets,
@@ -222,46 +244,91 @@ def train_step(optimizer,
         targets_segmentation=None,
         rngs={"dropout": dropout_rng})
 
+    weights = jnp.where(targets > 0, 1, 0).astype(jnp.float32)
     loss, weight_sum = compute_weighted_cross_entropy(
         logits, targets, weights, label_smoothing)
     mean_loss = loss / weight_sum
-    return mean_loss, logits
-
-  step = optimizer.state.step
-  lr = learning_rate_fn(step)
-  grad_fn = jax.value_and_grad(loss_fn, has_aux=True)
-  (_, logits), grad = grad_fn(optimizer.target)
-  grad = jax.lax.pmean(grad, "batch")
+    return mean_loss, (logits, weights)
+
+  if dynamic_scale:
+    grad_fn = dynamic_scale.value_and_grad(
+        loss_fn, has_aux=True, axis_name="batch")
+    dynamic_scale, is_fin, (_, (logits, weights)), grad = grad_fn(
+        optimizer.target)
+    # dynamic loss takes care of averaging gradients across replicas
+  else:
+    grad_fn = jax.value_and_grad(loss_fn, has_aux=True)
+    (_, (logits, weights)), grad = grad_fn(optimizer.target)
+    grad = jax.lax.pmean(grad, "batch")
   new_optimizer = optimizer.apply_gradient(grad, learning_rate=lr)
   metrics = compute_metrics(logits, targets, weights)
   metrics["learning_rate"] = lr
 
-  return new_optimizer, metrics, new_dropout_rng
+  if dynamic_scale:
+    # if is_fin == False the gradients contain Inf/NaNs and the old optimizer
+    # state should be restored.
+    new_optimizer = jax.tree_multimap(
+        functools.partial(jnp.where, is_fin), new_optimizer, optimizer)
+    metrics["scale"] = dynamic_scale.scale
 
+  return new_optimizer, dynamic_scale, metrics
 
-def eval_step(params, batch, config, label_smoothing=0.0):
+
+def eval_step(params, batch, model, label_smoothing=0.0):
   """Calculate evaluation metrics on a batch."""
   inputs, targets = batch["inputs"], batch["targets"]
-  teacher_forcing_targets = copy.deepcopy(targets)[:, :-1]
+  teacher_forcing_targets = targets[:, :-1]
   targets = targets[:, 1:]
   weights = jnp.where(targets > 0, 1.0, 0.0)
-  logits = models.Transformer(config).apply({"params": params}, inputs, teacher_forcing_targets)
+  logits = model.apply({"params": params}, inputs, teacher_forcing_targets)
 
   return compute_metrics(logits, targets, weights, label_smoothing)
 
 
-def initialize_cache(inputs, max_decode_len, config):
+def initialize_cache(inputs, max_decode_len, model):
   """Initialize a cache for a given input shape and max decode length."""
   target_shape = (inputs.shape[0], max_decode_len) + inputs.shape[2:]
-  initial_variables = models.Transformer(config).init(
-      jax.random.PRNGKey(0),
-      jnp.ones(inputs.shape, config.dtype),
-      jnp.ones(target_shape, config.dtype))
-  return initial_variables["cache"]
+  # The initial cache is all zeros, so only its shapes are taken from the
+  # model with eval_shape, without running the full init.
+  cache_shapes = jax.eval_shape(
+      lambda: model.init(
+          jax.random.PRNGKey(0),
+          jnp.ones(inputs.shape, model.config.dtype),
+          jnp.ones(target_shape, model.config.dtype))["cache"])
+  return jax.tree_map(lambda s: jnp.zeros(s.shape, s.dtype), cache_shapes)
+
+
+def quantize_params(params):
+  """Quantize the embeddings and the logit kernel to int8 for decoding.
+
+  Weights-only quantization with one float32 scale per vocab entry, stored in
+  a "scale" param next to each quantized weight. The result is read by a
+  Transformer whose config has quantized=True.
+
+  Args:
+    params: model params.
+
+  Returns:
+    The params with the quantized weights and their scales.
+  """
+  flat = traverse_util.flatten_dict(unfreeze(params))
+  for path in list(flat):
+    if path[-1] == "embedding":
+      axis = -1  # [vocab, emb_dim]
+    elif path[-2:] == ("logitdense", "kernel"):
+      axis = 0  # [emb_dim, vocab]
+    else:
+      continue
+    x = flat[path]
+    scale = jnp.max(jnp.abs(x), axis=axis, keepdims=True) / 127.
+    scale = jnp.maximum(scale, jnp.finfo(jnp.float32).tiny)
+    flat[path] = jnp.round(x / scale).astype(jnp.int8)
+    flat[path[:-1] + ("scale",)] = scale.astype(jnp.float32)
+  return freeze(traverse_util.unflatten_dict(flat))
 
 
 #def predict_step(inputs, params, cache, config, eos_id=2, max_decode_len=128, 
-def predict_step(inputs, params, cache, eos_id, max_decode_len, config,
+def predict_step(inputs, params, cache, eos_id, max_decode_len, model,
                  beam_size=4):
   """Predict translation with fast decoding beam search on a batch."""
   # Prepare transformer fast-decoder call for beam search: for beam search, we
@@ -271,16 +338,16 @@ def predict_step(inputs, params, cache, eos_id, max_decode_len, config,
   # i.e. if we denote each batch element subtensor as el[n]:
   # [el0, el1, el2] --> beamsize=2 --> [el0,el0,el1,el1,el2,el2]
   encoded_inputs = decode.flat_batch_beam_expand(
-      models.Transformer(config).apply({"params": params},
-                                       inputs,
-                                       method=models.Transformer.encode),
+      model.apply({"params": params},
+                  inputs,
+                  method=models.Transformer.encode),
       beam_size)
   raw_inputs = decode.flat_batch_beam_expand(inputs, beam_size)
 
   def tokens_ids_to_logits(flat_ids, flat_cache):
     """Token slice to logits from decoder model."""
     # --> [batch * beam, 1, vocab]
-    flat_logits, new_vars = models.Transformer(config).apply(
+    flat_logits, new_vars = model.apply(
         {
             "params": params,
             "cache": flat_cache
@@ -317,13 +384,20 @@ def predict_step(inputs, params, cache, eos_id, max_decode_len, config,
 # -----------------------------------------------------------------------------
 
 def pad_examples(x, desired_batch_size):
-  """Expand batch to desired size by repeating last slice."""
+  """Expand batch to desired size with zero (padding) examples."""
   batch_pad = desired_batch_size - x.shape[0]
-  return np.concatenate([x, np.tile(x[-1], (batch_pad, 1))], axis=0)
+  return np.pad(x, [(0, batch_pad)] + [(0, 0)] * (x.ndim - 1))
 
 
 def per_host_sum_pmap(in_tree):
   """Execute psum on in_tree"s leaves over one device per host."""
+  if jax.host_count() == 1:
+    return in_tree
+  if hasattr(multihost_utils, "process_allgather"):
+    gathered = multihost_utils.process_allgather(in_tree)
+    return jax.tree_map(lambda x: np.asarray(x).sum(0), gathered)
+  # Older jax has no process_allgather, fall back to a pmap over one device
+  # per host.
   host2devices = collections.defaultdict(list)
   for d in jax.devices():
     host2devices[d.host_id].append(d)
@@ -337,6 +411,20 @@ def per_host_sum_pmap(in_tree):
   return post_pmap(host_psum(pre_pmap(in_tree)))
 
 
+def shard_iter(ds, padded_size=None):
+  """Converts batches of a TF dataset to numpy and shards them to devices.
+
+  With padded_size set, every batch is padded up to that many examples and
+  gets an "example_mask" entry that is False for the padding examples.
+  """
+  for batch in ds:
+    batch = jax.tree_map(lambda x: x._numpy(), batch)  # pylint: disable=protected-access
+    if padded_size:
+      batch["example_mask"] = np.ones(batch["inputs"].shape[0], np.bool_)
+      batch = jax.tree_map(lambda x: pad_examples(x, padded_size), batch)
+    yield common_utils.shard(batch)
+
+
 def tohost(x):
   """Collect batches from all devices to host and flatten batch dimensions."""
   n_device, n_batch, *remaining_dims = x.shape
@@ -361,7 +449,6 @@ def train_and_evaluate(config: ml_collections.ConfigDict, workdir: str, ckptdir:
     jax_config.update('jax_disable_jit', True)
 
   if jax.host_id() == 0:
-    tf.io.gfile.makedirs(workdir)
     train_summary_writer = tensorboard.SummaryWriter(
         os.path.join(workdir, "train"))
     eval_summary_writer = tensorboard.SummaryWriter(
@@ -392,12 +479,22 @@ def train_and_evaluate(config: ml_collections.ConfigDict, workdir: str, ckptdir:
       max_corpus_chars=config.max_corpus_chars,
       max_length=config.max_target_length,
       max_eval_length=config.max_eval_target_length)
-  train_iter = iter(train_ds)
+  # Keep the next batches already transferred to the devices while the
+  # current step runs.
+  train_iter = jax_utils.prefetch_to_device(shard_iter(train_ds), 2)
   vocab_size = int(encoder.vocab_size())
   eos_id = decode.EOS_ID  # Default Sentencepiece EOS token.
+  @tf.function(input_signature=[tf.TensorSpec([None, None], tf.int32)])
+  def detokenize(toks):
+    # Cut every row after its first EOS and detokenize the whole batch in a
+    # single graph call.
+    lengths = tf.argmax(tf.cast(tf.equal(toks, eos_id), tf.int32), axis=1) + 1
+    return encoder.detokenize(
+        tf.RaggedTensor.from_tensor(toks, lengths=lengths))
+
   def decode_tokens(toks):
-    valid_toks = toks[:np.argmax(toks == eos_id) + 1].astype(np.int32)
-    return encoder.detokenize(valid_toks).numpy().decode("utf-8")
+    return [s.decode("utf-8")
+            for s in detokenize(toks.astype(np.int32)).numpy()]
 
   if config.num_predict_steps > 0:
     predict_ds = predict_ds.take(config.num_predict_steps)
@@ -427,7 +524,14 @@ def train_and_evaluate(config: ml_collections.ConfigDict, workdir: str, ckptdir:
       kernel_init=nn.initializers.xavier_uniform(),
       bias_init=nn.initializers.normal(stddev=1e-6))
   eval_config = train_config.replace(deterministic=True)
-  predict_config = train_config.replace(deterministic=True, decode=True)
+  predict_config = train_config.replace(
+      deterministic=True, decode=True, quantized=config.quantize_predict)
+  # With use_bfloat16 the layers compute in bfloat16 while the params, the
+  # optimizer state and the loss stay in float32.
+  # Build each model once, the step functions below close over them.
+  train_model = models.Transformer(train_config)
+  eval_model = models.Transformer(eval_config)
+  predict_model = models.Transformer(predict_config)
 
   start_step = 0
   rng = random.PRNGKey(config.seed)
@@ -435,8 +539,7 @@ def train_and_evaluate(config: ml_collections.ConfigDict, workdir: str, ckptdir:
   input_shape = (config.batch_size, config.max_target_length)
   target_shape = (config.batch_size, config.max_target_length)
 
-  m = models.Transformer(eval_config)
-  initial_variables = jax.jit(m.init)(init_rng, jnp.ones(input_shape, jnp.float32),
+  initial_variables = jax.jit(eval_model.init)(init_rng, jnp.ones(input_shape, jnp.float32),
                   jnp.ones(target_shape, jnp.float32))
 
   # apply an optimizer to this tree
@@ -460,6 +563,13 @@ def train_and_evaluate(config: ml_collections.ConfigDict, workdir: str, ckptdir:
   # Replicate optimizer.
   optimizer = jax_utils.replicate(optimizer)
 
+  # Optional dynamic loss scaling. bfloat16 has the exponent range of float32,
+  # so it does not need it, and it costs a finiteness check over all gradients
+  # plus a select over the whole optimizer state every step.
+  dynamic_scale = None
+  if config.dynamic_scale:
+    dynamic_scale = jax_utils.replicate(optim.DynamicScale())
+
   learning_rate_fn = create_learning_rate_scheduler(
       base_learning_rate=config.learning_rate, warmup_steps=config.warmup_steps)
 
@@ -468,27 +578,25 @@ def train_and_evaluate(config: ml_collections.ConfigDict, workdir: str, ckptdir:
     p_train_step = jax.vmap(
         functools.partial(
           train_step,
-          config=train_config,
-          learning_rate_fn=learning_rate_fn,
+          model=train_model,
           label_smoothing=config.label_smoothing),
         axis_name="batch")
     p_init_cache = jax.vmap(
         functools.partial(
           initialize_cache,
           max_decode_len=config.max_predict_length,
-          config=predict_config),
+          model=predict_model),
         axis_name="batch")
     p_pred_step = jax.vmap(
         functools.partial(
-          predict_step, config=predict_config, beam_size=config.beam_size),
+          predict_step, model=predict_model, beam_size=config.beam_size),
         axis_name="batch")
 
   else:
     p_train_step = jax.pmap(
         functools.partial(
           train_step,
-          config=train_config,
-          learning_rate_fn=learning_rate_fn,
+          model=train_model,
           label_smoothing=config.label_smoothing),
         axis_name="batch",
         donate_argnums=(0,))  # pytype: disable=wrong-arg-types
@@ -496,36 +604,48 @@ def train_and_evaluate(config: ml_collections.ConfigDict, workdir: str, ckptdir:
         functools.partial(
           initialize_cache,
           max_decode_len=config.max_predict_length,
-          config=predict_config),
+          model=predict_model),
         axis_name="batch")
     p_pred_step = jax.pmap(
         functools.partial(
-          predict_step, config=predict_config, beam_size=config.beam_size),
+          predict_step, model=predict_model, beam_size=config.beam_size),
         axis_name="batch",
         static_broadcasted_argnums=(3, 4))  # eos token, max_length are constant
 
+  p_quantize_params = jax.pmap(quantize_params)
+  p_accumulate_metrics = jax.pmap(
+      lambda total, metrics: jax.tree_multimap(jnp.add, total, metrics),
+      donate_argnums=(0,))
   p_eval_step = jax.pmap(
       functools.partial(
-          eval_step, config=eval_config,
+          eval_step, model=eval_model,
           label_smoothing=config.label_smoothing),
       axis_name="batch")
   
   # Main Train Loop
   # ---------------------------------------------------------------------------
 
-  # We init the first set of dropout PRNG keys, but update it afterwards inside
-  # the main pmap"d training update for performance.
+  # One dropout PRNG key per device, each step folds the step number into it
+  # inside the main pmap"d training update.
   dropout_rngs = random.split(rng, n_devices)
 
   logging.info("Starting training loop.")
-  metrics_all = []
+  # Train metrics are summed on the devices and only fetched to the host when
+  # they are logged.
+  metrics_sum, num_metrics_steps = None, 0
   t_loop_start = time.time()
   for step, batch in zip(range(start_step, config.num_train_steps), train_iter):
-    # Shard data to devices and do a training step.
-    batch = common_utils.shard(jax.tree_map(lambda x: x._numpy(), batch))  # pylint: disable=protected-access
-    optimizer, metrics, dropout_rngs = p_train_step(
-        optimizer, batch, dropout_rngs)
-    metrics_all.append(metrics)
+    # Batches arrive already sharded to devices, do a training step.
+    lr = jax_utils.replicate(learning_rate_fn(step))
+    optimizer, dynamic_scale, metrics = p_train_step(
+        optimizer, batch, dropout_rngs, lr, dynamic_scale)
+    # Only the latest loss scale is logged, so it is not summed.
+    scale = metrics.pop("scale", None)
+    if metrics_sum is None:
+      metrics_sum = metrics
+    else:
+      metrics_sum = p_accumulate_metrics(metrics_sum, metrics)
+    num_metrics_steps += 1
 
     # Quick indication that training is happening.
     logging.log_first_n(logging.INFO, "Finished training step %d.", 5, step)
@@ -542,12 +662,13 @@ def train_and_evaluate(config: ml_collections.ConfigDict, workdir: str, ckptdir:
 
     # Training Metrics
     logging.info("Gathering training metrics.")
-    metrics_all = common_utils.get_metrics(metrics_all)
-    lr = metrics_all.pop("learning_rate").mean()
-    metrics_sums = jax.tree_map(jnp.sum, metrics_all)
+    metrics_sums = jax.device_get(jax_utils.unreplicate(metrics_sum))
+    lr = metrics_sums.pop("learning_rate") / num_metrics_steps
     denominator = metrics_sums.pop("denominator")
     summary = jax.tree_map(lambda x: x / denominator, metrics_sums)  # pylint: disable=cell-var-from-loop
     summary["learning_rate"] = lr
+    if scale is not None:
+      summary["scale"] = jax.device_get(jax_utils.unreplicate(scale))
     steps_per_eval = config.eval_frequency if step != 0 else 1
     steps_per_sec = steps_per_eval / (time.time() - t_loop_start)
     t_loop_start = time.time()
@@ -556,18 +677,21 @@ def train_and_evaluate(config: ml_collections.ConfigDict, workdir: str, ckptdir:
       for key, val in summary.items():
         train_summary_writer.scalar(key, val, step)
       train_summary_writer.flush()
-    metrics_all = []
+    metrics_sum, num_metrics_steps = None, 0
     logging.info("train in step: %d, loss: %.4f", step, summary["loss"])
 
+    # Eval and predict share the same replicated params handle, they are not
+    # donated since training keeps using them.
+    params = optimizer.target
+
     # Eval Metrics
     logging.info("Gathering evaluation metrics.")
     t_eval_start = time.time()
     eval_metrics = []
-    eval_iter = iter(eval_ds)
-    for _, eval_batch in zip(range(config.num_eval_steps), eval_iter):
-      eval_batch = jax.tree_map(lambda x: x._numpy(), eval_batch)  # pylint: disable=protected-access
-      eval_batch = common_utils.shard(eval_batch)
-      metrics = p_eval_step(optimizer.target, eval_batch)
+    eval_iter = jax_utils.prefetch_to_device(
+        shard_iter(eval_ds.take(config.num_eval_steps)), 2)
+    for eval_batch in eval_iter:
+      metrics = p_eval_step(params, eval_batch)
       eval_metrics.append(metrics)
     eval_metrics = common_utils.get_metrics(eval_metrics)
     eval_metrics_sums = jax.tree_map(jnp.sum, eval_metrics)
@@ -585,31 +709,31 @@ def train_and_evaluate(config: ml_collections.ConfigDict, workdir: str, ckptdir:
     # Translation and BLEU Score.
     logging.info("Translating evaluation dataset.")
     t_inference_start = time.time()
+    if config.quantize_predict:
+      pred_params = p_quantize_params(params)
+    else:
+      pred_params = params
     sources, references, predictions = [], [], []
-    for pred_batch in predict_ds:
-      pred_batch = jax.tree_map(lambda x: x._numpy(), pred_batch)  # pylint: disable=protected-access
-      # Handle final odd-sized batch by padding instead of dropping it.
-      cur_pred_batch_size = pred_batch["inputs"].shape[0]
-      if cur_pred_batch_size % n_devices:
-        padded_size = int(
-            np.ceil(cur_pred_batch_size / n_devices) * n_devices)
-        pred_batch = jax.tree_map(
-            lambda x: pad_examples(x, padded_size), pred_batch)  # pylint: disable=cell-var-from-loop
-      pred_batch = common_utils.shard(pred_batch)
+    # The odd-sized final batch is padded to the full batch size instead of
+    # dropped, so every batch has the same shape and p_pred_step (with the
+    # beam search decoder inside it) is compiled only once.
+    predict_iter = jax_utils.prefetch_to_device(
+        shard_iter(predict_ds, padded_size=config.batch_size), 2)
+    for pred_batch in predict_iter:
       cache = p_init_cache(pred_batch["inputs"])
       if config.debug:
-        predicted = p_pred_step(pred_batch["inputs"], optimizer.target, cache)
+        predicted = p_pred_step(pred_batch["inputs"], pred_params, cache)
       else:
-        predicted = p_pred_step(pred_batch["inputs"], optimizer.target, cache,
+        predicted = p_pred_step(pred_batch["inputs"], pred_params, cache,
                                 eos_id, config.max_predict_length)
-      predicted = tohost(predicted)
-      inputs = tohost(pred_batch["inputs"])
-      targets = tohost(pred_batch["targets"])
-      # Iterate through non-padding examples of batch.
-      for i, s in enumerate(predicted[:cur_pred_batch_size]):
-        sources.append(decode_tokens(inputs[i]))
-        references.append(decode_tokens(targets[i]))
-        predictions.append(decode_tokens(s))
+      # Keep only the non-padding examples of the batch.
+      example_mask = tohost(pred_batch["example_mask"])
+      predicted = tohost(predicted)[example_mask]
+      inputs = tohost(pred_batch["inputs"])[example_mask]
+      targets = tohost(pred_batch["targets"])[example_mask]
+      sources.extend(decode_tokens(inputs))
+      references.extend(decode_tokens(targets))
+      predictions.extend(decode_tokens(predicted))
     print("Source : {}".format(sources[0]))
     print("Target : {}".format(references[0]))
     print("Hypothesis : {}".format(predictions[0]))
@@ -624,7 +748,7 @@ def train_and_evaluate(config: ml_collections.ConfigDict, workdir: str, ckptdir:
     bleu_score = bleu.complete_bleu(*all_bleu_matches)
     # Save translation samples for tensorboard.
     exemplars = ""
-    for n in np.random.choice(np.arange(len(predictions)), 8):
+    for n in np.random.randint(0, len(predictions), size=8):
       exemplars += f"{sources[n]}\n\n{references[n]}\n\n{predictions[n]}\n\n"
     if jax.host_id() == 0:
       eval_summary_writer.scalar("bleu", bleu_score, step)
@@ -17,13 +17,31 @@ import tempfile
 
 from absl import logging
 from absl.testing import absltest
+from flax import linen as nn
+from flax import traverse_util
+from flax.core import freeze, unfreeze
+from flax.training import checkpoints
 import jax
+import jax.numpy as jnp
+import models
+import numpy as np
 import train
 from configs import default
 import tensorflow as tf
 import tensorflow_datasets as tfds
 
 
+def dequantize_params(params):
+  """Rebuild float32 params from the output of train.quantize_params."""
+  flat = traverse_util.flatten_dict(unfreeze(params))
+  for path in list(flat):
+    # LayerNorm params are also named "scale", so match the quantized weights.
+    if path[-1] == "embedding" or path[-2:] == ("logitdense", "kernel"):
+      scale = flat.pop(path[:-1] + ("scale",))
+      flat[path] = flat[path].astype(jnp.float32) * scale
+  return freeze(traverse_util.unflatten_dict(flat))
+
+
 class TrainTest(absltest.TestCase):
   """Test cases for WMT library."""
 
@@ -56,6 +74,77 @@ class TrainTest(absltest.TestCase):
       train.train_and_evaluate(config, workdir)
     logging.info("workdir content: %s", tf.io.gfile.listdir(workdir))
 
+  def test_quantize_params_round_trip(self):
+    rng = np.random.RandomState(0)
+    params = {
+        "shared_embedding": {
+            "embedding": rng.normal(size=(16, 8)).astype(np.float32)},
+        "decoder": {
+            "logitdense": {
+                "kernel": rng.normal(size=(8, 16)).astype(np.float32),
+                "bias": rng.normal(size=(16,)).astype(np.float32)},
+            "Dense_0": {
+                "kernel": rng.normal(size=(8, 8)).astype(np.float32)}},
+    }
+    quantized = traverse_util.flatten_dict(
+        unfreeze(train.quantize_params(params)))
+    embedding_path = ("shared_embedding", "embedding")
+    kernel_path = ("decoder", "logitdense", "kernel")
+    self.assertEqual(quantized[embedding_path].dtype, jnp.int8)
+    self.assertEqual(quantized[kernel_path].dtype, jnp.int8)
+    self.assertEqual(quantized[("shared_embedding", "scale")].shape, (16, 1))
+    self.assertEqual(quantized[("decoder", "logitdense", "scale")].shape,
+                     (1, 16))
+
+    restored = traverse_util.flatten_dict(unfreeze(
+        dequantize_params(train.quantize_params(params))))
+    flat = traverse_util.flatten_dict(params)
+    self.assertEqual(set(restored), set(flat))
+    for path, x in flat.items():
+      if path in (embedding_path, kernel_path):
+        # Rounding to the nearest step is off by at most half a step.
+        scale = quantized[path[:-1] + ("scale",)]
+        bound = scale / 2 + 1e-6
+        self.assertTrue(np.all(np.abs(restored[path] - x) <= bound))
+      else:
+        np.testing.assert_array_equal(restored[path], x)
+
+  def test_quantized_transformer_matches_dequantized(self):
+    config = models.TransformerConfig(
+        vocab_size=16, output_vocab_size=16, emb_dim=8, num_heads=2,
+        num_layers=1, qkv_dim=8, mlp_dim=16, max_len=8, deterministic=True)
+    inputs = jnp.array([[3, 4, 5, 2, 0, 0]], jnp.int32)
+    targets = jnp.array([[1, 6, 7, 2, 0, 0]], jnp.int32)
+    params = models.Transformer(config).init(
+        jax.random.PRNGKey(0), inputs, targets)["params"]
+    quantized = train.quantize_params(params)
+
+    logits = models.Transformer(config.replace(quantized=True)).apply(
+        {"params": quantized}, inputs, targets)
+    expected = models.Transformer(config).apply(
+        {"params": dequantize_params(quantized)}, inputs, targets)
+    np.testing.assert_allclose(logits, expected, rtol=1e-4, atol=1e-4)
+
+  def test_embed_restores_nn_embed_checkpoint(self):
+    inputs = jnp.array([[3, 1, 0]], jnp.int32)
+    query = jnp.ones((1, 8), jnp.float32)
+    legacy = nn.Embed(16, 8, embedding_init=nn.initializers.normal(stddev=1.0))
+    legacy_params = legacy.init(jax.random.PRNGKey(0), inputs)["params"]
+    ckptdir = tempfile.mkdtemp()
+    checkpoints.save_checkpoint(ckptdir, legacy_params, 0)
+
+    embed = models.Embed(16, 8)
+    target = embed.init(jax.random.PRNGKey(1), inputs)["params"]
+    self.assertEqual(jax.tree_util.tree_structure(target),
+                     jax.tree_util.tree_structure(legacy_params))
+    restored = checkpoints.restore_checkpoint(ckptdir, target)
+    np.testing.assert_array_equal(
+        embed.apply({"params": restored}, inputs),
+        legacy.apply({"params": legacy_params}, inputs))
+    np.testing.assert_array_equal(
+        embed.apply({"params": restored}, query, method=models.Embed.attend),
+        legacy.apply({"params": legacy_params}, query, method=nn.Embed.attend))
+
 
 if __name__ == "__main__":
   absltest.main()